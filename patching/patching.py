@@ -17,7 +17,6 @@
 A module to simplify the process of patching functions and methods.
 
 Contains:
-    - ``Static``: A helper class to make certain classes 'static'.
     - ``OutVar``: A class to patch functions and methods to return the final state of parameters \
 upon return.
         - ``patch``: A method to patch a function or method for returning specified out variables.
@@ -35,17 +34,110 @@ or method.
 """
 
 ### pylint: disable=method-hidden, not-callable, expression-not-assigned, too-few-public-methods
-### pylint: disable=multiple-statements
+### pylint: disable=multiple-statements, protected-access
 
+import builtins
+import dis
 import inspect
 import sys
-from types import FunctionType, ModuleType
-from typing import Any, TypeVar, TypeAlias
-from copy import copy, deepcopy
+import weakref
+from types import CodeType, FunctionType, ModuleType
+from typing import TypeVar, TypeAlias
 from collections.abc import Iterable, Callable
 
-import bytecode.bytecode as bc
-import bytecode
+
+# the bytecode library, only imported once ``OutVar.patch`` has code to rewrite
+# importing this module to use ``Patching`` alone doesn't pay for it
+_bytecode = None
+
+# patched code objects, keyed by the id of the code they were built from and the captured names
+# entries are dropped once the code they were built from is collected, so ids are never reused
+_PATCH_CODE_CACHE: dict[tuple[int, tuple[str, ...]], CodeType] = {}
+
+# ids of the functions currently patched with ``OutVar.patch``
+# each one maps to the finalizer that drops it from here once the function is collected
+_PATCH_REGISTRY: dict[int, weakref.finalize] = {}
+
+# names of the ``Patching`` instances that have hooked the __import__ builtin
+_IMPORT_HOOK_NAMES: set[str] = set()
+
+# the opcodes used when rewriting returns
+_RETURN_VALUE = "RETURN_VALUE"
+_LOAD_FAST = "LOAD_FAST"
+_BUILD_TUPLE = "BUILD_TUPLE"
+_RETURN_VALUE_OP = dis.opmap[_RETURN_VALUE]
+
+
+def _rewrite_returns(instrs: list, names: tuple[str, ...]) -> list:
+    """Makes every ``RETURN_VALUE`` in a list of instructions also return the given locals.
+
+    The return value and the final state of each name are packed into a tuple before \
+returning. ``instrs`` is replaced in place with the rewritten instructions.
+
+    Args:
+        instrs (list): The instructions to rewrite, usually a ``bytecode.Bytecode``.
+        names (tuple[str, ...]): The names of the locals to return.
+
+    Returns:
+        list: The rewritten instructions.
+    """
+
+    # aliasing
+    Instr = _bytecode.Instr
+
+    # the size of the tuple that is returned: the return value plus every captured name
+    tuple_size = len(names) + 1
+
+    # build the new instruction list in a single pass
+    # appending is linear, where inserting into the list shifts its whole tail each time
+    rewritten = []
+
+    for instr in instrs:
+        # we want to change the return value of the function
+        # only look further when the opcode is returning from the function.
+        if instr.__class__ is Instr and instr.name == _RETURN_VALUE:
+            # get the location of the return value
+            # the new instructions should inherit this
+            # locations are immutable, so all of them can share the same one
+            loc = instr.location
+
+            # place all of the captured parameters in the stack
+            # after the original return value
+            rewritten.extend([Instr(_LOAD_FAST, x, location=loc) for x in names])
+
+            # build a tuple with all of the necessary arguments.
+            rewritten.append(Instr(_BUILD_TUPLE, tuple_size, location=loc))
+
+        rewritten.append(instr)
+
+    instrs[:] = rewritten
+
+    return instrs
+
+
+def _callback_has_result(callback: Callable) -> bool:
+    """Returns whether or not a prefix or postfix callback takes a ``_result`` parameter.
+
+    The answer is stored on the callback, so each callback is only inspected once.
+
+    Args:
+        callback (Callable): The prefix or postfix callback to check.
+
+    Returns:
+        bool: Whether or not the callback takes ``_result``.
+    """
+    has_result = getattr(callback, '_outvar_has_result', None)
+
+    if has_result is None:
+        has_result = '_result' in inspect.signature(callback).parameters
+
+        # not every callable accepts new attributes, those are just inspected every time
+        try:
+            callback._outvar_has_result = has_result
+        except (AttributeError, TypeError):
+            pass
+
+    return has_result
 
 
 class _Helper:
@@ -81,6 +173,9 @@ Defaults to None.
 
         Returns:
             CallableT: Returns the original function after the successful patching.
+
+        Raises:
+            ValueError: If any of the names is not a local variable of the function.
         """
 
         # if run as a decorator or without a names argument, capture all parameters
@@ -88,80 +183,91 @@ Defaults to None.
             names = func.__code__.co_varnames
 
         # if names is just a single parameter, make it a tuple
-        if names.__class__ is str:
-            names = (names,)
+        # otherwise, turn whatever iterable was given into one
+        names = (names,) if isinstance(names, str) else tuple(names)
 
         # if no names are provided, return the original function
         # no need to capture any params
         if len(names) == 0:
             return func
 
+        # fail here rather than with an obscure error when assembling or calling the patched code
+        co_varnames = func.__code__.co_varnames
+        missing = [x for x in names if x not in co_varnames]
+
+        if missing:
+            raise ValueError(f"{missing} not found in the local variables of {func.__name__}.")
+
         oldfunc = None
 
         # if the function is already patched, get the original function
         # repatch the original function with the new params
-        if OutVar.is_patched(func):
-            if not OutVar.get_capture(func) is None:
-                names += OutVar.get_capture(func)
+        # check the registry rather than the attributes,
+        # since copies of the function's __dict__ carry those too
+        if id(func) in _PATCH_REGISTRY:
+            captured = func._outvar_captured
+
+            # the new names go first, without repeating names that are already captured
+            names = tuple(dict.fromkeys(names + captured))
+
+            # the new names already lead the capture, the current patch already does the job
+            # callers rely on the order, e.g. ``_result`` at index 1 for prefixes and postfixes
+            if names == captured:
+                return func
 
             # get the original function
-            oldfunc = OutVar.get_original(func)
+            oldfunc = func._outvar_original
 
         # if the original function has been accessed, operate on that code
         # if not, use the function from arguments
-        newcode = bc.Bytecode.from_code(oldfunc.__code__ if not oldfunc is None else func.__code__)
-
-        # aliasing
-        Instr = bytecode.Instr
-
-        ind = 0
-        for instr in copy(newcode):
-            # we want to change the return value of the function
-            # continue when the opcode isn't returning from the function.
-
-            #print(instr.__class__, instr)
-
-            if not instr.__class__ is Instr:
-                ind += 1
-                continue
-            if instr.name != "RETURN_VALUE":
-                ind += 1
-                continue
-
-            # get the line number of the return value
-            # the new instructions should inherit this
-            ln = instr.lineno
-
-            # place all of the captured parameters in the stack
-            # after the original return value
-            for x in names:
-                newcode.insert(ind, Instr('LOAD_FAST', x, lineno=ln))
-                ind += 1
-
-            # build a tuple with all of the necessary arguments.
-            newcode.insert(ind, Instr('BUILD_TUPLE', len(names) + 1, lineno=ln))
-
-            # keep track of the actual index we should insert at
-            ind += 2
-
-        # build the old function from parts, as a deepcopy
-
-        ### pylint: disable-next=invalid-name
-        OLD_FUNC = FunctionType(
-            deepcopy(func.__code__),
-            func.__globals__,
-            deepcopy(func.__name__),
-            deepcopy(func.__defaults__),
-            deepcopy(func.__closure__)
-        )
+        code = oldfunc.__code__ if oldfunc is not None else func.__code__
+
+        # the rewrite only depends on the code and the names,
+        # so reuse the code from a previous patch when there is one
+        key = (id(code), names)
+        patched_code = _PATCH_CODE_CACHE.get(key)
+
+        # every instruction is a 2 byte code unit, so the even bytes of co_code are the opcodes
+        # without a return to rewrite, the code can be used as it is
+        if patched_code is None and _RETURN_VALUE_OP not in code.co_code[::2]:
+            patched_code = code
+
+        if patched_code is None:
+            ### pylint: disable-next=global-statement
+            global _bytecode
+
+            if _bytecode is None:
+                ### pylint: disable-next=import-outside-toplevel, redefined-outer-name
+                import bytecode as _bytecode
+
+            newcode = _bytecode.Bytecode.from_code(code)
+
+            _rewrite_returns(newcode, names)
+
+            patched_code = newcode.to_code()
+            _PATCH_CODE_CACHE[key] = patched_code
+            weakref.finalize(code, _PATCH_CODE_CACHE.pop, key, None)
+
+        # a repatch keeps the original it already has
+        # otherwise, build the old function from parts
+        # code objects, names, defaults and closures are all immutable, so they can be shared
+        if oldfunc is None:
+            oldfunc = FunctionType(
+                func.__code__,
+                func.__globals__,
+                func.__name__,
+                func.__defaults__,
+                func.__closure__
+            )
 
         # replace the original functions code with the patched code
-        func.__code__ = newcode.to_code()
-        # set a property on the newly patched function to store information about the patch
-        func.OUTPATCHINFO = {
-            "captured": names,
-            "original": oldfunc if not oldfunc is None else OLD_FUNC
-        }
+        func.__code__ = patched_code
+        # set properties on the newly patched function to store information about the patch
+        func._outvar_captured = names
+        func._outvar_original = oldfunc
+
+        if id(func) not in _PATCH_REGISTRY:
+            _PATCH_REGISTRY[id(func)] = weakref.finalize(func, _PATCH_REGISTRY.pop, id(func), None)
 
         return func
 
@@ -175,11 +281,13 @@ Defaults to None.
         Returns:
             _Helper.CallableT: The original function or method.
         """
-        if not OutVar.is_patched(func):
+        if id(func) not in _PATCH_REGISTRY:
             return func
 
-        func.__code__ = OutVar.get_original(func).__code__
-        del func.OUTPATCHINFO
+        func.__code__ = func._outvar_original.__code__
+        del func._outvar_captured
+        del func._outvar_original
+        _PATCH_REGISTRY.pop(id(func)).detach()
 
         return func
 
@@ -196,7 +304,11 @@ Defaults to None.
         if not OutVar.is_patched(func):
             return None
 
-        return func.OUTPATCHINFO
+        # the information is stored as separate attributes, only build the dict when asked for
+        return {
+            "captured": func._outvar_captured,
+            "original": func._outvar_original
+        }
 
     @staticmethod
     def get_capture(func: Callable) -> tuple:
@@ -211,7 +323,7 @@ Defaults to None.
         if not OutVar.is_patched(func):
             return None
 
-        return func.OUTPATCHINFO["captured"]
+        return func._outvar_captured
 
     @staticmethod
     def get_original(func: Callable) -> Callable:
@@ -226,7 +338,7 @@ Defaults to None.
         if not OutVar.is_patched(func):
             return None
 
-        return func.OUTPATCHINFO["original"]
+        return func._outvar_original
 
     @staticmethod
     def is_patched(func: Callable) -> bool:
@@ -238,7 +350,7 @@ Defaults to None.
         Returns:
             bool: Whether or not the function or method has been patched.
         """
-        return hasattr(func, 'OUTPATCHINFO')
+        return id(func) in _PATCH_REGISTRY
 
 
 class Patching:
@@ -257,71 +369,48 @@ class Patching:
         self._PATCH_INFO = {}
         self.name = name
 
-        self.prefix = self._patch__import__(self.prefix)
-        self.postfix = self._patch__import__(self.postfix)
-
-    def _patch__import__(self, func: _Helper.CallableT) -> _Helper.CallableT:
-        """Patches the import builtin for the running module to allow for proactive patching.
+        self._install_import_hook()
 
-        Args:
-            func (Callable): The function that should ensure __import__ is patched.
+    def _install_import_hook(self) -> None:
+        """Patches the import builtin to allow for proactive patching.
 
-        Returns:
-            Callable: The origin function.
+        The hook is installed once per name, so ``prefix`` and ``postfix`` never have to \
+        check for it.
         """
 
-        def _wrapper(*args, **kwargs) -> Any:
-            """A wrapper used in the patching of the __import__ builtin.
+        if self.name in _IMPORT_HOOK_NAMES:
+            return
 
-            Returns:
-                Any: The result of the original function.
-            """
+        import_func = builtins.__import__
 
-            builtins = inspect.currentframe().f_back.f_globals["__builtins__"]
-
-            if hasattr(builtins.__import__, "PATCH") and builtins.__import__.PATCH.get(self.name):
-                return func(*args, **kwargs)
-
-            def process_imports(_, __, result: 'ModuleType') -> None:
-                """
-                Function that is monkeypatched to the end of the __import__ builtin to \
-                process imports.
-
-                Args:
-                    _ (Any): Positional needed for patching. Ignored.
-                    __ (Any): Positional needed for patching. Ignored.
-                    result ('ModuleType'): The result of the import.
-                """
-
-                #print(f"""Intercepted import of {result.__name__}.""")
-
-                if result.__name__ in self._PATCH_INFO:
-                    for tup in copy(self._PATCH_INFO[result.__name__]):
-                        patch_type, name, prefix = tup
+        def process_imports(*args, **kwargs) -> 'ModuleType':
+            """
+            Function that replaces the __import__ builtin to process imports.
 
-                        if patch_type == "prefix":
-                            self._prefix_atom(result, name, prefix)
+            The original __import__ is called directly rather than through \
+            ``elementary_postfix``, since this runs on every import in the process.
 
-                        if patch_type == "postfix":
-                            self._postfix_atom(result, name, prefix)
+            Returns:
+                ModuleType: The result of the import.
+            """
 
-                        self._PATCH_INFO[result.__name__].remove(tup)
+            result = import_func(*args, **kwargs)
 
-                return result
+            #print(f"""Intercepted import of {result.__name__}.""")
 
-            builtins.__import__ = self.elementary_postfix(
-                builtins.__import__,
-                process_imports
-            )
+            # take every patch queued for this module off the queue at once
+            for patch_type, name, prefix in self._PATCH_INFO.pop(result.__name__, ()):
+                if patch_type == "prefix":
+                    self._prefix_atom(result, name, prefix)
 
-            if not hasattr(builtins.__import__, "PATCH"):
-                builtins.__import__.PATCH = {}
+                if patch_type == "postfix":
+                    self._postfix_atom(result, name, prefix)
 
-            builtins.__import__.PATCH[self.name] = True
+            return result
 
-            return func(*args, **kwargs)
+        builtins.__import__ = process_imports
 
-        return _wrapper
+        _IMPORT_HOOK_NAMES.add(self.name)
 
     def _prefix_atom(self, base: 'ModuleType', name: str, prefix: Callable) -> None:
         """Patches a function or method in a module to have a prefix.
@@ -344,41 +433,43 @@ class Patching:
         Raises:
             AttributeError: If the target function is not found in the module.
         """
-        if name in dir(base):
-            # the function to patch
+        # the function to patch
+        try:
             this_func = getattr(base, name)
+        except AttributeError:
+            raise AttributeError(f"{name} not found in {base}.") from None
 
-            # wrapper for the prefix
+        # patch the prefix for its _result out var once, when installing
+        # and pick the wrapper for it now, instead of branching on every call
+        if _callback_has_result(prefix):
+            prefix = OutVar.patch(prefix, '_result')
+
+            # wrapper for a prefix that uses _result
             def _wrapper(*args, **kwargs):
                 """Wrapper function for ``Patching._prefix_atom``.
 
                 Returns:
-                    Any: Either the return value of the function or prefix.
+                    Any: Either the return value of the function or ``_result``.
                 """
-                nonlocal prefix
-                _result = None
-
-                has_result = '_result' in inspect.signature(prefix).parameters
-
-                if has_result:
-                    OutVar.patch(prefix, '_result')
-
-                prefix_out = prefix(args, kwargs, _result)
+                # _result always starts out as None for a prefix
+                prefix_out = prefix(args, kwargs, None)
 
-                if has_result:
-                    _result = prefix_out[1]
+                if prefix_out[0] is not False:
+                    return this_func(*args, **kwargs)
 
-                    if not prefix_out[0] is False:
-                        return this_func(*args, **kwargs)
-
-                    return _result
-
-                return None if prefix_out is False else this_func(*args, **kwargs)
+                return prefix_out[1]
 
+        else:
+            # wrapper for a prefix without _result
+            def _wrapper(*args, **kwargs):
+                """Wrapper function for ``Patching._prefix_atom``.
 
-            setattr(base, name, _wrapper)
+                Returns:
+                    Any: Either the return value of the function or None.
+                """
+                return None if prefix(args, kwargs, None) is False else this_func(*args, **kwargs)
 
-        else: raise AttributeError(f"{name} not found in {base}.")
+        setattr(base, name, _wrapper)
 
     def _postfix_atom(self, base: 'ModuleType', name: str, postfix: Callable) -> None:
         """Patches a function or method in a module to have a postfix.
@@ -400,31 +491,37 @@ class Patching:
             AttributeError: If the target function is not found in the module.
         """
 
-        if name in dir(base):
+        # the function to patch
+        try:
             this_func = getattr(base, name)
+        except AttributeError:
+            raise AttributeError(f"{name} not found in {base}.") from None
 
-            def _wrapper(*args, **kwargs):
-                nonlocal postfix
+        # patch the postfix for its _result out var once, when installing
+        # and pick the wrapper for it now, instead of branching on every call
+        if _callback_has_result(postfix):
+            postfix = OutVar.patch(postfix, '_result')
 
+            # wrapper for a postfix that uses _result
+            def _wrapper(*args, **kwargs):
                 _result = this_func(*args, **kwargs)
 
-                has_result = '_result' in inspect.signature(postfix).parameters
+                # the patched postfix returns its own return value and the final _result
+                # followed by anything else it captures
+                postfix_ret, _result, *_ = postfix(args, kwargs, _result)
 
-                if has_result:
-                    postfix = OutVar.patch(postfix, '_result')
+                return _result if _result else postfix_ret
 
-                postfix_out = postfix(args, kwargs, _result)
-
-                if has_result:
-                    _result = postfix_out[1]
+        else:
+            # wrapper for a postfix without _result
+            def _wrapper(*args, **kwargs):
+                _result = this_func(*args, **kwargs)
 
-                    return _result or postfix_out[0]
+                postfix(args, kwargs, _result)
 
                 return _result
 
-            setattr(base, name, _wrapper)
-
-        else: raise AttributeError(f"{name} not found in {base}.")
+        setattr(base, name, _wrapper)
 
     def elementary_prefix(
             self,
@@ -445,7 +542,7 @@ class Patching:
 
         def _prefix_wrapper(*args, **kwargs):
             prefix(args, kwargs)
-            return func(*args, *kwargs)
+            return func(*args, **kwargs)
 
         return _prefix_wrapper
 
@@ -501,25 +598,20 @@ class Patching:
             prefix (Callable): The prefix function to apply.
         """
 
-        last_frame_globals = inspect.currentframe().f_back.f_globals
+        last_frame_globals = sys._getframe(1).f_globals
 
-        if module in sys.modules and name in sys.modules[module].__dict__:
-            module = sys.modules[module]
+        # one lookup each for the imported module and the module in the caller's scope
+        loaded = sys.modules.get(module)
+        scoped = last_frame_globals.get(module)
 
-            self._prefix_atom(module, name, prefix)
+        if loaded is not None and hasattr(loaded, name):
+            self._prefix_atom(loaded, name, prefix)
 
-        elif module in last_frame_globals \
-                and last_frame_globals[module].__class__ is ModuleType:
-
-            module = last_frame_globals[module]
-
-            self._prefix_atom(module, name, prefix)
+        elif scoped.__class__ is ModuleType:
+            self._prefix_atom(scoped, name, prefix)
 
         else:
-            if not module in self._PATCH_INFO:
-                self._PATCH_INFO[module] = set()
-
-            self._PATCH_INFO[module].add(("prefix", name, prefix))
+            self._PATCH_INFO.setdefault(module, []).append(("prefix", name, prefix))
 
     def postfix(self, module: str, name: str, postfix: Callable) -> None:
         """A function that simplifies the process of postfixing a function or method.
@@ -544,22 +636,17 @@ class Patching:
             name (str): The name of the target function.
             postfix (Callable): The postfix function to apply.
         """
-        last_frame_globals = inspect.currentframe().f_back.f_globals
+        last_frame_globals = sys._getframe(1).f_globals
 
-        if module in sys.modules and name in sys.modules[module].__dict__:
-            module = sys.modules[module]
+        # one lookup each for the imported module and the module in the caller's scope
+        loaded = sys.modules.get(module)
+        scoped = last_frame_globals.get(module)
 
-            self._postfix_atom(module, name, postfix)
+        if loaded is not None and hasattr(loaded, name):
+            self._postfix_atom(loaded, name, postfix)
 
-        elif module in last_frame_globals \
-                and last_frame_globals[module].__class__ is ModuleType:
-
-            module = last_frame_globals[module]
-
-            self._postfix_atom(module, name, postfix)
+        elif scoped.__class__ is ModuleType:
+            self._postfix_atom(scoped, name, postfix)
 
         else:
-            if not module in self._PATCH_INFO:
-                self._PATCH_INFO[module] = set()
-
-            self._PATCH_INFO[module].add(("postfix", name, postfix))
+            self._PATCH_INFO.setdefault(module, []).append(("postfix", name, postfix))